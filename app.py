@@ -1,7 +1,13 @@
 
 import os
+import sys
 import logging
+import sqlite3
+from pathlib import Path
 from flask import Flask
+from sqlalchemy import event, insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateIndex
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Configure logging
@@ -12,6 +18,16 @@ app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
+# Keep sessions server-side in Redis when one is configured; otherwise fall
+# back to Flask's signed cookie sessions
+redis_url = os.environ.get("REDIS_URL")
+if redis_url:
+    import redis
+    from flask_session import Session
+    app.config["SESSION_TYPE"] = "redis"
+    app.config["SESSION_REDIS"] = redis.from_url(redis_url)
+    Session(app)
+
 # Configure the database with UTF-8 encoding
 database_url = "sqlite:///biryani_club.db"  # Force SQLite for now
 if database_url.startswith("sqlite"):
@@ -24,205 +40,205 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "connect_args": {"check_same_thread": False} if database_url.startswith("sqlite") else {}
 }
 
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Use WAL journaling and a larger page cache on every SQLite connection"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-65536")  # 64 MB
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB
+    cursor.close()
+
+# Precomputed generate_password_hash() output for the default seed accounts
+# (admin123 / delivery123), so first-run seeding skips two password hashings
+ADMIN_PASSWORD_HASH = 'scrypt:32768:8:1$VyHtynza1GX6j6Pa$119646e998963cbba665988ba11cbf6170cc0fb71f59ca262f2924f4b160c34e9bf901f4cd44e74312df9131b20164924833739ebc5fd591549c9fb93810e9d8'
+DELIVERY_PASSWORD_HASH = 'scrypt:32768:8:1$hrMneijN2xzPo6nr$791d92ced9e982daf66fee84b03c4c5cf2e92f3cddb2840ca6acfffa8649091576ef10db43307d51ab6a11fbdb49ce3f468ff4b49cfbc6a4fa5787dcd2d82814'
+
 # Initialize SQLAlchemy
 from models import db
 db.init_app(app)
 
-# Create tables and initialize data within app context
-with app.app_context():
+# Written once create_all() and seeding have succeeded, so later worker starts
+# can skip them. It holds SCHEMA_VERSION; bump that when init_db() gains an
+# upgrade step so existing databases run it once.
+SCHEMA_MARKER = Path(app.instance_path) / '.schema_initialized'
+SCHEMA_VERSION = '3'
+
+def load_seed(filename, shared_fields=()):
+    """Load seed rows (a list of column mappings) from a JSON file next to app.py
+
+    Values of ``shared_fields`` repeat across many rows and are interned so
+    every row references a single string object.
+    """
+    import json
+    with open(os.path.join(app.root_path, filename), encoding='utf-8') as f:
+        rows = json.load(f)
+    for row in rows:
+        for field in shared_fields:
+            if row.get(field) is not None:
+                row[field] = sys.intern(row[field])
+    return rows
+
+def ensure_cart_item_unique():
+    """Add the (user_id, menu_item_id) unique index to an older cart_item table
+
+    create_all() leaves existing tables alone, but the cart upsert's ON
+    CONFLICT needs this constraint. Duplicate lines are merged first, keeping
+    the oldest row with the summed quantity (capped like the upsert).
+    """
+    from models import CartItem
+    from utils import MAX_CART_QUANTITY
+
+    columns = ['user_id', 'menu_item_id']
+    inspector = db.inspect(db.engine)
+    if any(uc['column_names'] == columns for uc in inspector.get_unique_constraints('cart_item')) or \
+            any(ix['unique'] and ix['column_names'] == columns for ix in inspector.get_indexes('cart_item')):
+        return
+
+    duplicates = db.session.query(
+        CartItem.user_id, CartItem.menu_item_id, db.func.min(CartItem.id), db.func.sum(CartItem.quantity)
+    ).group_by(CartItem.user_id, CartItem.menu_item_id).having(db.func.count() > 1).all()
+    for user_id, menu_item_id, keep_id, quantity in duplicates:
+        CartItem.query.filter(
+            CartItem.user_id == user_id, CartItem.menu_item_id == menu_item_id, CartItem.id != keep_id
+        ).delete(synchronize_session=False)
+        CartItem.query.filter_by(id=keep_id).update(
+            {'quantity': min(quantity, MAX_CART_QUANTITY)}, synchronize_session=False
+        )
+    db.session.commit()
+    # Plain DDL, so no second uq_cartitem_user_item object is attached to the
+    # model's table alongside its UniqueConstraint
+    db.session.execute(db.text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_cartitem_user_item ON cart_item (user_id, menu_item_id)'
+    ))
+    db.session.commit()
+    print(f"Merged {len(duplicates)} duplicate cart lines and added uq_cartitem_user_item")
+
+def create_index_if_missing(index):
+    """Emit CREATE INDEX IF NOT EXISTS for a model index
+
+    Index.create(checkfirst=True) relies on reflection, which skips
+    expression indexes such as lower(username) on SQLite and would try to
+    create them a second time.
+    """
+    with db.engine.begin() as connection:
+        connection.execute(CreateIndex(index, if_not_exists=True))
+
+def ensure_user_lower_indexes():
+    """Add the lower(username) / lower(email) unique indexes to an older user table
+
+    Login and registration compare lower(column), which only uses an index
+    once these exist. Accounts that collide case-insensitively cannot be
+    merged automatically, so they are reported and that index is skipped
+    until they are resolved by hand.
+    """
+    from models import User
+
+    for column in (User.username, User.email):
+        index = next(ix for ix in User.__table__.indexes if ix.name == f'ix_user_lower_{column.key}')
+        collisions = db.session.query(db.func.lower(column)).group_by(
+            db.func.lower(column)
+        ).having(db.func.count() > 1).all()
+        if collisions:
+            values = ', '.join(value for value, in collisions)
+            print(f"Skipping {index.name}: {column.key} values differ only by case: {values}")
+            continue
+        create_index_if_missing(index)
+
+def ensure_indexes():
+    """Add the models' non-unique indexes missing from older tables
+
+    create_all() only creates indexes together with a new table. Unique
+    indexes depend on the existing rows and have their own upgrade steps.
+    """
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if not index.unique:
+                create_index_if_missing(index)
+
+def init_db():
+    """Create tables and load default settings, users, menu and promotions"""
     # Import models to ensure tables are created
     from models import User, MenuItem, CartItem, Order, OrderItem, StoreSettings, Promotion
     
     # Create all tables
     db.create_all()
+    ensure_cart_item_unique()
+    ensure_user_lower_indexes()
+    ensure_indexes()
     
-    # Initialize default data if not exists
-    if StoreSettings.query.count() == 0:
-        # Add default store settings
-        StoreSettings.set_setting('store_open', 'true')
-        StoreSettings.set_setting('delivery_radius', '10')
-        StoreSettings.set_setting('base_delivery_charge', '30')
-        print("Default store settings added")
-        
-    # Create admin user if not exists
-    if User.query.filter_by(role='admin').count() == 0:
-        admin_user = User(
-            username='admin',
-            email='admin@biryaniclub.com',
-            full_name='Admin User',
-            role='admin',
-            phone='9999999999'
-        )
-        admin_user.set_password('admin123')
-        db.session.add(admin_user)
-        try:
-            db.session.commit()
-            print("Admin user created: username=admin, password=admin123")
-        except Exception as e:
-            db.session.rollback()
-            print(f"Error creating admin user: {e}")
+    # Initialize default data if not exists, all within a single transaction
+    seeded = []
+    try:
+        if db.session.query(StoreSettings.id).first() is None:
+            # Add default store settings
+            db.session.add_all([
+                StoreSettings(key='store_open', value='true'),
+                StoreSettings(key='delivery_radius', value='10'),
+                StoreSettings(key='base_delivery_charge', value='30'),
+            ])
+            seeded.append("Default store settings added")
             
-    # Create delivery person if not exists
-    if User.query.filter_by(role='delivery').count() == 0:
-        delivery_user = User(
-            username='delivery',
-            email='delivery@biryaniclub.com',
-            full_name='Delivery Person',
-            role='delivery',
-            phone='8888888888'
-        )
-        delivery_user.set_password('delivery123')
-        db.session.add(delivery_user)
-        try:
-            db.session.commit()
-            print("Delivery user created: username=delivery, password=delivery123")
-        except Exception as e:
-            db.session.rollback()
-            print(f"Error creating delivery user: {e}")
-    
-    # Add complete menu items if none exist
-    if MenuItem.query.count() == 0:
-        menu_items = [
-            # Biryani
-            MenuItem(name='Veg Biryani', description='Fragrant basmati rice with mixed vegetables', price=99, category='Biryani', emoji='🍛', popularity=8),
-            MenuItem(name='Veg Biryani (Large)', description='Fragrant basmati rice with mixed vegetables', price=189, category='Biryani', emoji='🍛', popularity=8),
-            MenuItem(name='Egg Biryani', description='Aromatic rice with boiled eggs', price=109, category='Biryani', emoji='🍛', popularity=7),
-            MenuItem(name='Egg Biryani (Large)', description='Aromatic rice with boiled eggs', price=199, category='Biryani', emoji='🍛', popularity=7),
-            MenuItem(name='Paneer Biryani', description='Premium paneer pieces with fragrant rice', price=129, category='Biryani', emoji='🍛', popularity=9),
-            MenuItem(name='Paneer Biryani (Large)', description='Premium paneer pieces with fragrant rice', price=239, category='Biryani', emoji='🍛', popularity=9),
-            MenuItem(name='Manchurian Biryani', description='Crispy manchurian with aromatic rice', price=109, category='Biryani', emoji='🍛', popularity=6),
-            MenuItem(name='Manchurian Biryani (Large)', description='Crispy manchurian with aromatic rice', price=199, category='Biryani', emoji='🍛', popularity=6),
-            MenuItem(name='Mushroom Biryani', description='Fresh mushrooms with spiced rice', price=109, category='Biryani', emoji='🍛', popularity=6),
-            MenuItem(name='Mushroom Biryani (Large)', description='Fresh mushrooms with spiced rice', price=199, category='Biryani', emoji='🍛', popularity=6),
-            MenuItem(name='Chicken Biryani', description='Tender chicken pieces with aromatic rice', price=119, category='Biryani', emoji='🍛', popularity=10),
-            MenuItem(name='Chicken Biryani (Large)', description='Tender chicken pieces with aromatic rice', price=219, category='Biryani', emoji='🍛', popularity=10),
-            MenuItem(name='Chicken Biryani (Premium)', description='Premium chicken biryani with extra spices', price=139, category='Biryani', emoji='🍛', popularity=10),
-            MenuItem(name='Chicken Biryani (Premium Large)', description='Premium chicken biryani with extra spices', price=249, category='Biryani', emoji='🍛', popularity=10),
-
-            # Rolls & Chowmein
-            MenuItem(name='Veg Roll', description='Fresh vegetables wrapped in soft bread', price=29, category='Rolls & Chowmein', emoji='🌯', popularity=7),
-            MenuItem(name='Egg Roll', description='Scrambled eggs with onions in roll', price=39, category='Rolls & Chowmein', emoji='🌯', popularity=8),
-            MenuItem(name='Paneer Roll', description='Spiced paneer cubes in soft roll', price=79, category='Rolls & Chowmein', emoji='🌯', popularity=6),
-            MenuItem(name='Manchurian Roll', description='Crispy manchurian in roll wrap', price=49, category='Rolls & Chowmein', emoji='🌯', popularity=5),
-            MenuItem(name='Chicken Roll', description='Tender chicken pieces in roll', price=89, category='Rolls & Chowmein', emoji='🌯', popularity=9),
-            MenuItem(name='Chowmein (Small)', description='Stir-fried noodles with vegetables', price=10, category='Rolls & Chowmein', emoji='🍜', popularity=4),
-            MenuItem(name='Chowmein (Medium)', description='Stir-fried noodles with vegetables', price=20, category='Rolls & Chowmein', emoji='🍜', popularity=5),
-            MenuItem(name='Chowmein (Large)', description='Stir-fried noodles with vegetables', price=40, category='Rolls & Chowmein', emoji='🍜', popularity=6),
-            MenuItem(name='Veg Chowmein', description='Vegetable noodles with sauce', price=49, category='Rolls & Chowmein', emoji='🍜', popularity=6),
-            MenuItem(name='Veg Chowmein (Large)', description='Vegetable noodles with sauce', price=99, category='Rolls & Chowmein', emoji='🍜', popularity=6),
-            MenuItem(name='Paneer Chowmein', description='Paneer cubes with noodles', price=59, category='Rolls & Chowmein', emoji='🍜', popularity=5),
-            MenuItem(name='Paneer Chowmein (Large)', description='Paneer cubes with noodles', price=109, category='Rolls & Chowmein', emoji='🍜', popularity=5),
-            MenuItem(name='Egg Chowmein', description='Egg noodles with scrambled eggs', price=49, category='Rolls & Chowmein', emoji='🍜', popularity=7),
-            MenuItem(name='Egg Chowmein (Large)', description='Egg noodles with scrambled eggs', price=99, category='Rolls & Chowmein', emoji='🍜', popularity=7),
-            MenuItem(name='Chicken Chowmein', description='Chicken pieces with noodles', price=79, category='Rolls & Chowmein', emoji='🍜', popularity=8),
-            MenuItem(name='Chicken Chowmein (Large)', description='Chicken pieces with noodles', price=149, category='Rolls & Chowmein', emoji='🍜', popularity=8),
-
-            # Bread
-            MenuItem(name='Plain Roti', description='Fresh wheat bread', price=12, category='Bread', emoji='🍞', popularity=8),
-            MenuItem(name='Butter Roti', description='Roti with butter', price=15, category='Bread', emoji='🍞', popularity=7),
-            MenuItem(name='Plain Naan', description='Traditional Indian bread', price=25, category='Bread', emoji='🫓', popularity=9),
-            MenuItem(name='Butter Naan', description='Naan with butter', price=35, category='Bread', emoji='🫓', popularity=9),
-            MenuItem(name='Garlic Naan', description='Naan with garlic and herbs', price=49, category='Bread', emoji='🫓', popularity=8),
-            MenuItem(name='Lachha Paratha', description='Layered wheat bread', price=29, category='Bread', emoji='🫓', popularity=7),
-
-            # Rice
-            MenuItem(name='Plain Rice', description='Steamed basmati rice', price=69, category='Rice', emoji='🍚', popularity=6),
-            MenuItem(name='Veg Fried Rice', description='Rice with mixed vegetables', price=79, category='Rice', emoji='🍚', popularity=7),
-            MenuItem(name='Jeera Rice', description='Cumin flavored rice', price=79, category='Rice', emoji='🍚', popularity=6),
-            MenuItem(name='Schezwan Rice', description='Spicy rice with schezwan sauce', price=99, category='Rice', emoji='🍚', popularity=5),
-            MenuItem(name='Mix Fried Rice', description='Rice with mixed vegetables and protein', price=119, category='Rice', emoji='🍚', popularity=6),
-            MenuItem(name='Egg Fried Rice', description='Rice with scrambled eggs', price=89, category='Rice', emoji='🍚', popularity=7),
-            MenuItem(name='Chicken Fried Rice', description='Rice with chicken pieces', price=99, category='Rice', emoji='🍚', popularity=8),
-
-            # Starters
-            MenuItem(name='Chilli Potato', description='Crispy potato with spicy sauce', price=69, category='Starters', emoji='🥔', popularity=8),
-            MenuItem(name='Chilli Potato (Large)', description='Crispy potato with spicy sauce', price=129, category='Starters', emoji='🥔', popularity=8),
-            MenuItem(name='Honey Chilli Potato', description='Sweet and spicy potato', price=89, category='Starters', emoji='🥔', popularity=7),
-            MenuItem(name='Honey Chilli Potato (Large)', description='Sweet and spicy potato', price=169, category='Starters', emoji='🥔', popularity=7),
-            MenuItem(name='Veg Manchurian', description='Deep fried vegetable balls', price=49, category='Starters', emoji='🥗', popularity=6),
-            MenuItem(name='Veg Manchurian (Large)', description='Deep fried vegetable balls', price=99, category='Starters', emoji='🥗', popularity=6),
-            MenuItem(name='Paneer Manchurian', description='Paneer cubes in manchurian sauce', price=89, category='Starters', emoji='🧀', popularity=7),
-            MenuItem(name='Paneer Manchurian (Large)', description='Paneer cubes in manchurian sauce', price=169, category='Starters', emoji='🧀', popularity=7),
-            MenuItem(name='Chicken Manchurian', description='Chicken pieces in spicy sauce', price=119, category='Starters', emoji='🍗', popularity=9),
-            MenuItem(name='Chicken Manchurian (Large)', description='Chicken pieces in spicy sauce', price=209, category='Starters', emoji='🍗', popularity=9),
-            MenuItem(name='Crispy Baby Corn', description='Crispy baby corn with sauce', price=199, category='Starters', emoji='🌽', popularity=5),
-            MenuItem(name='Paneer Chilli', description='Spicy paneer cubes', price=199, category='Starters', emoji='🧀', popularity=7),
-            MenuItem(name='Baby Corn Chilli', description='Spicy baby corn preparation', price=189, category='Starters', emoji='🌽', popularity=5),
-            MenuItem(name='Chicken Chilli', description='Spicy chicken preparation', price=229, category='Starters', emoji='🍗', popularity=9),
-            MenuItem(name='Boneless Chilli', description='Boneless chicken in spicy sauce', price=249, category='Starters', emoji='🍗', popularity=8),
-            MenuItem(name='Paneer Tikka', description='Grilled paneer cubes', price=199, category='Starters', emoji='🧀', popularity=8),
-            MenuItem(name='Malai Paneer Tikka', description='Creamy paneer tikka', price=229, category='Starters', emoji='🧀', popularity=7),
-            MenuItem(name='Chicken Lollipop', description='Chicken drumettes in spicy coating', price=199, category='Starters', emoji='🍗', popularity=8),
-
-            # Main Course
-            MenuItem(name='Dal Tadka', description='Yellow lentils with tempering', price=119, category='Main Course', emoji='🍛', popularity=7),
-            MenuItem(name='Dal Makhni', description='Creamy black lentils', price=139, category='Main Course', emoji='🍛', popularity=8),
-            MenuItem(name='Chana Masala', description='Spiced chickpeas curry', price=119, category='Main Course', emoji='🍛', popularity=6),
-            MenuItem(name='Shahi Paneer', description='Paneer in rich tomato gravy', price=199, category='Main Course', emoji='🧀', popularity=9),
-            MenuItem(name='Kadhai Paneer', description='Paneer cooked in kadhai style', price=199, category='Main Course', emoji='🧀', popularity=8),
-            MenuItem(name='Paneer Butter Masala', description='Paneer in buttery tomato sauce', price=199, category='Main Course', emoji='🧀', popularity=9),
-            MenuItem(name='Handi Paneer', description='Paneer cooked in clay pot style', price=209, category='Main Course', emoji='🧀', popularity=7),
-            MenuItem(name='Kadhai Chicken', description='Chicken cooked kadhai style', price=249, category='Main Course', emoji='🍗', popularity=9),
-            MenuItem(name='Butter Chicken', description='Chicken in creamy tomato sauce', price=269, category='Main Course', emoji='🍗', popularity=10),
-            MenuItem(name='Chicken Curry', description='Traditional chicken curry', price=239, category='Main Course', emoji='🍗', popularity=8),
-            MenuItem(name='Kaju Butter Masala', description='Cashew nuts in butter sauce', price=199, category='Main Course', emoji='🥜', popularity=6),
-            MenuItem(name='Mushroom Masala', description='Mushrooms in spiced gravy', price=189, category='Main Course', emoji='🍄', popularity=5),
-            MenuItem(name='Mushroom Curry', description='Mushroom curry with spices', price=189, category='Main Course', emoji='🍄', popularity=5),
-        ]
+        # Create admin user if not exists
+        if db.session.query(User.id).filter_by(role='admin').first() is None:
+            admin_user = User(
+                username='admin',
+                email='admin@biryaniclub.com',
+                full_name='Admin User',
+                role='admin',
+                phone='9999999999',
+                password_hash=ADMIN_PASSWORD_HASH
+            )
+            db.session.add(admin_user)
+            seeded.append("Admin user created: username=admin, password=admin123")
+                
+        # Create delivery person if not exists
+        if db.session.query(User.id).filter_by(role='delivery').first() is None:
+            delivery_user = User(
+                username='delivery',
+                email='delivery@biryaniclub.com',
+                full_name='Delivery Person',
+                role='delivery',
+                phone='8888888888',
+                password_hash=DELIVERY_PASSWORD_HASH
+            )
+            db.session.add(delivery_user)
+            seeded.append("Delivery user created: username=delivery, password=delivery123")
         
-        for item in menu_items:
-            db.session.add(item)
+        # Add complete menu items and sample promotions if none exist
+        if db.session.query(MenuItem.id).first() is None:
+            db.session.execute(insert(MenuItem), load_seed('menu_seed.json', shared_fields=('category', 'emoji')))
+            if db.session.query(Promotion.id).first() is None:
+                db.session.execute(insert(Promotion), load_seed('promotion_seed.json'))
+            seeded.append("Complete menu items and sample promotions added")
         
-        try:
-            db.session.commit()
-            print("Complete menu items added")
-            
-            # Add sample promotions if none exist
-            if Promotion.query.count() == 0:
-                sample_promotions = [
-                    Promotion(
-                        code='WELCOME10',
-                        description='Welcome offer - 10% off on first order',
-                        discount_type='percentage',
-                        discount_value=10,
-                        min_order_amount=100,
-                        max_discount=100,
-                        usage_limit=None,
-                        expires_at=None,
-                        is_active=True
-                    ),
-                    Promotion(
-                        code='SAVE50',
-                        description='Get flat ₹50 off on orders above ₹300',
-                        discount_type='fixed',
-                        discount_value=50,
-                        min_order_amount=300,
-                        max_discount=None,
-                        usage_limit=None,
-                        expires_at=None,
-                        is_active=True
-                    ),
-                    Promotion(
-                        code='BIRYANI20',
-                        description='Special biryani discount - 20% off',
-                        discount_type='percentage',
-                        discount_value=20,
-                        min_order_amount=200,
-                        max_discount=150,
-                        usage_limit=100,
-                        expires_at=None,
-                        is_active=True
-                    )
-                ]
-                
-                for promo in sample_promotions:
-                    db.session.add(promo)
-                
-                db.session.commit()
-                print('Sample promotions added')
-        except Exception as e:
-            db.session.rollback()
-            print(f"Error adding menu items: {e}")
-    
-    # Import routes after everything is initialized
-    import routes
+        db.session.commit()
+        for message in seeded:
+            print(message)
+        # Only a fully seeded database is marked, so a failed seed is retried
+        # on the next start
+        SCHEMA_MARKER.write_text(SCHEMA_VERSION)
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error initializing default data: {e}")
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create tables and seed default data (run once per database)"""
+    init_db()
+
+# First run convenience: initialize automatically only until the schema marker
+# is current (and the database file is still there), so warm starts skip
+# create_all() and the seeding probes entirely
+with app.app_context():
+    if not SCHEMA_MARKER.exists() or SCHEMA_MARKER.read_text() != SCHEMA_VERSION \
+            or not os.path.exists(db.engine.url.database):
+        init_db()
+
+# Register the views once the database is ready
+from routes import bp
+app.register_blueprint(bp)
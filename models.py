@@ -1,41 +1,59 @@
+import time
+from bisect import bisect_right
 from datetime import datetime
-import pytz
-from werkzeug.security import generate_password_hash, check_password_hash
-import re
-import random
-import string
+from zoneinfo import ZoneInfo
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, or_, update
 
 db = SQLAlchemy()
 
+IST = ZoneInfo('Asia/Kolkata')
+
 def get_ist_now():
     """Get current IST time"""
-    ist = pytz.timezone('Asia/Kolkata')
-    return datetime.now(ist).replace(tzinfo=None)
+    return datetime.now(IST).replace(tzinfo=None)
+
+# Loyalty tiers ordered by points: (name, min_points, max_points, conversion_rate, color)
+LOYALTY_TIERS = (
+    ('bronze', 0, 999, 5, '#CD7F32'),
+    ('silver', 1000, 2499, 4, '#C0C0C0'),
+    ('gold', 2500, 4999, 3, '#FFD700'),
+    ('platinum', 5000, float('inf'), 2, '#E5E4E2'),
+)
+_TIER_NAMES = tuple(tier[0] for tier in LOYALTY_TIERS)
+_TIER_THRESHOLDS = tuple(tier[1] for tier in LOYALTY_TIERS[1:])
+# Shared, read-only tier info returned by User.get_loyalty_tier_info
+_TIER_INFO = {
+    name: {'min_points': min_points, 'max_points': max_points, 'conversion_rate': rate, 'color': color}
+    for name, min_points, max_points, rate, color in LOYALTY_TIERS
+}
 
 class User(db.Model):
     __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80), unique=True, nullable=False)
-    email = db.Column(db.String(120), unique=True, nullable=False)
+    username = db.Column(db.String(80), nullable=False)  # unique case-insensitively, see below
+    email = db.Column(db.String(120), nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
     full_name = db.Column(db.String(100))
     phone = db.Column(db.String(15), unique=True)
-    role = db.Column(db.String(20), default='customer')  # customer, admin, delivery
+    role = db.Column(db.String(20), default='customer', index=True)  # customer, admin, delivery
     loyalty_points = db.Column(db.Integer, default=0)
     loyalty_tier = db.Column(db.String(20), default='bronze')  # bronze, silver, gold, platinum
     created_at = db.Column(db.DateTime, default=get_ist_now)
     is_active = db.Column(db.Boolean, default=True)
 
     # Relationships
-    orders = db.relationship('Order', foreign_keys='Order.user_id', backref='user', lazy=True)
+    orders = db.relationship('Order', foreign_keys='Order.user_id', backref=db.backref('user', lazy='selectin'), lazy=True)
     delivered_orders = db.relationship('Order', foreign_keys='Order.delivery_person_id', backref='delivery_person_user', lazy=True)
     cart_items = db.relationship('CartItem', backref='user', lazy=True, cascade='all, delete-orphan')
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        from werkzeug.security import generate_password_hash
+        # scrypt runs in OpenSSL via hashlib; older pbkdf2 hashes still verify
+        self.password_hash = generate_password_hash(password, method='scrypt:32768:8:1')
 
     def check_password(self, password):
+        from werkzeug.security import check_password_hash
         return check_password_hash(self.password_hash, password)
 
     def is_admin(self):
@@ -46,25 +64,21 @@ class User(db.Model):
     
     def get_loyalty_tier_info(self):
         """Get loyalty tier information based on points"""
-        tiers = {
-            'bronze': {'min_points': 0, 'max_points': 999, 'conversion_rate': 5, 'color': '#CD7F32'},
-            'silver': {'min_points': 1000, 'max_points': 2499, 'conversion_rate': 4, 'color': '#C0C0C0'},
-            'gold': {'min_points': 2500, 'max_points': 4999, 'conversion_rate': 3, 'color': '#FFD700'},
-            'platinum': {'min_points': 5000, 'max_points': float('inf'), 'conversion_rate': 2, 'color': '#E5E4E2'}
-        }
-        
         # Update tier based on current points
-        current_tier = 'bronze'
-        for tier, info in tiers.items():
-            if info['min_points'] <= self.loyalty_points <= info['max_points']:
-                current_tier = tier
-                break
+        current_tier = _TIER_NAMES[bisect_right(_TIER_THRESHOLDS, self.loyalty_points)]
         
         # Update tier if changed
         if self.loyalty_tier != current_tier:
             self.loyalty_tier = current_tier
             
-        return tiers[current_tier]
+        return _TIER_INFO[current_tier]
+    
+    def get_points_to_next_tier(self):
+        """Points still needed to reach the next tier (0 at the top tier)"""
+        next_tier = bisect_right(_TIER_THRESHOLDS, self.loyalty_points)
+        if next_tier == len(_TIER_THRESHOLDS):
+            return 0
+        return _TIER_THRESHOLDS[next_tier] - self.loyalty_points
     
     def get_redeemable_amount(self):
         """Calculate how much money can be redeemed from points"""
@@ -93,23 +107,44 @@ class User(db.Model):
     def __repr__(self):
         return f'<User {self.username}>'
 
+# Usernames and emails are unique regardless of case, and lookups compare
+# lower(column) so these functional indexes serve them directly
+db.Index('ix_user_lower_username', db.func.lower(User.username), unique=True)
+db.Index('ix_user_lower_email', db.func.lower(User.email), unique=True)
+
 class MenuItem(db.Model):
     __tablename__ = 'menu_item'
+    __table_args__ = (
+        # Serves the menu listing (category filter, in_stock, by popularity)
+        # as an ordered index scan without a separate sort step
+        db.Index('ix_menuitem_cat_stock_pop', 'category', 'in_stock', db.text('popularity DESC')),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
     price = db.Column(db.Float, nullable=False)
     category = db.Column(db.String(50), nullable=False)
     emoji = db.Column(db.String(10))
-    in_stock = db.Column(db.Boolean, default=True)
+    in_stock = db.Column(db.Boolean, default=True, index=True)
     popularity = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=get_ist_now)
 
     def __repr__(self):
         return f'<MenuItem {self.name}>'
 
+# On PostgreSQL a trigram GIN index makes the menu search's ILIKE '%term%'
+# index-backed while keeping substring matching; SQLite has no equivalent
+event.listen(MenuItem.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+event.listen(MenuItem.__table__, 'after_create',
+             DDL('CREATE INDEX ix_menuitem_name_trgm ON menu_item USING gin (name gin_trgm_ops)')
+             .execute_if(dialect='postgresql'))
+
 class CartItem(db.Model):
     __tablename__ = 'cart_item'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'menu_item_id', name='uq_cartitem_user_item'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     menu_item_id = db.Column(db.Integer, db.ForeignKey('menu_item.id'), nullable=False)
@@ -117,7 +152,7 @@ class CartItem(db.Model):
     created_at = db.Column(db.DateTime, default=get_ist_now)
 
     # Relationships
-    menu_item = db.relationship('MenuItem', backref='cart_items')
+    menu_item = db.relationship('MenuItem', backref='cart_items', lazy='joined')
 
     @property
     def total(self):
@@ -128,6 +163,11 @@ class CartItem(db.Model):
 
 class Order(db.Model):
     __tablename__ = 'order'
+    __table_args__ = (
+        db.Index('ix_order_user_status', 'user_id', 'status'),
+        db.Index('ix_order_status_created', 'status', 'created_at'),
+        db.Index('ix_order_delivery_lookup', 'delivery_person_id', 'status', 'delivery_time'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # Nullable for guest orders
     
@@ -147,12 +187,12 @@ class Order(db.Model):
     discount = db.Column(db.Float, default=0)
     total_amount = db.Column(db.Float, nullable=False)
     payment_method = db.Column(db.String(20), nullable=False)  # cash, upi
-    payment_status = db.Column(db.String(20), default='pending')  # pending, confirmed, failed
+    payment_status = db.Column(db.String(20), default='pending', index=True)  # pending, confirmed, failed
     coupon_code = db.Column(db.String(20))
     
     # Order status and tracking
     status = db.Column(db.String(20), default='pending')  # pending, confirmed, preparing, out_for_delivery, delivered, cancelled
-    created_at = db.Column(db.DateTime, default=get_ist_now)
+    created_at = db.Column(db.DateTime, default=get_ist_now, index=True)
     confirmed_at = db.Column(db.DateTime)
     delivery_time = db.Column(db.DateTime)
     
@@ -161,7 +201,7 @@ class Order(db.Model):
     delivery_notes = db.Column(db.Text)
     
     # Relationships
-    order_items = db.relationship('OrderItem', backref='order', lazy=True, cascade='all, delete-orphan')
+    order_items = db.relationship('OrderItem', backref='order', lazy='selectin', cascade='all, delete-orphan')
 
     @property
     def is_guest_order(self):
@@ -173,9 +213,8 @@ class Order(db.Model):
     @staticmethod
     def generate_order_number():
         """Generate random order number"""
-        prefix = "BC"
-        random_part = ''.join(random.choices(string.digits, k=6))
-        return f"{prefix}{random_part}"
+        import secrets
+        return f"BC{secrets.randbelow(100_000_000):08d}"
     
     @property
     def created_at_ist(self):
@@ -204,7 +243,7 @@ class Order(db.Model):
 class OrderItem(db.Model):
     __tablename__ = 'order_item'
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
     menu_item_id = db.Column(db.Integer, db.ForeignKey('menu_item.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     unit_price = db.Column(db.Float, nullable=False)
@@ -216,6 +255,30 @@ class OrderItem(db.Model):
     def __repr__(self):
         return f'<OrderItem {self.menu_item.name} x{self.quantity}>'
 
+# Process-local TTL cache for store settings and the menu and promotion lists
+# in utils.py: key -> (value, expires_at). Keys are tuples whose first item
+# names their group. Entries expire so changes made by other workers are
+# picked up within the TTL.
+_cache = {}
+_MISSING = object()
+SETTINGS_CACHE_TTL = 30
+
+def cached(key, loader, ttl):
+    """Return the cached value for key, calling loader() when missing or stale"""
+    now = time.monotonic()
+    entry = _cache.get(key)
+    if entry and entry[1] > now:
+        return entry[0]
+    value = loader()
+    _cache[key] = (value, now + ttl)
+    return value
+
+def invalidate_cached(prefix):
+    """Drop cached entries whose key starts with the prefix tuple"""
+    for key in list(_cache):
+        if key[:len(prefix)] == prefix:
+            _cache.pop(key, None)
+
 class StoreSettings(db.Model):
     __tablename__ = 'store_settings'
     id = db.Column(db.Integer, primary_key=True)
@@ -225,8 +288,11 @@ class StoreSettings(db.Model):
 
     @staticmethod
     def get_setting(key, default_value=None):
-        setting = StoreSettings.query.filter_by(key=key).first()
-        return setting.value if setting else default_value
+        def load():
+            setting = StoreSettings.query.filter_by(key=key).first()
+            return setting.value if setting else _MISSING
+        value = cached(('setting', key), load, SETTINGS_CACHE_TTL)
+        return default_value if value is _MISSING else value
 
     @staticmethod
     def set_setting(key, value):
@@ -238,6 +304,7 @@ class StoreSettings(db.Model):
             setting = StoreSettings(key=key, value=value)
             db.session.add(setting)
         db.session.commit()
+        invalidate_cached(('setting', key))
 
     def __repr__(self):
         return f'<StoreSettings {self.key}: {self.value}>'
@@ -288,27 +355,54 @@ class Promotion(db.Model):
                 not self.is_expired and 
                 not self.is_usage_exceeded)
 
-    def calculate_discount(self, subtotal):
-        """Calculate discount amount for given subtotal"""
-        if not self.is_valid or subtotal < self.min_order_amount:
-            return 0
-
+    def discount_amount(self, subtotal):
+        """Discount on subtotal; validity is checked in SQL by redeemable()/claim()"""
+        # Work in integer paise (and basis points) so discounts are exact
+        subtotal_paise = round(subtotal * 100)
         if self.discount_type == 'percentage':
-            discount = subtotal * (self.discount_value / 100)
+            discount_paise = subtotal_paise * round(self.discount_value * 100) // 10000
             if self.max_discount:
-                discount = min(discount, self.max_discount)
-            return discount
+                discount_paise = min(discount_paise, round(self.max_discount * 100))
         else:  # fixed amount
-            return min(self.discount_value, subtotal)
-
-    def use_promotion(self):
-        """Mark promotion as used"""
-        self.used_count += 1
-        db.session.commit()
+            discount_paise = min(round(self.discount_value * 100), subtotal_paise)
+        return discount_paise / 100
+
+    @classmethod
+    def redeemable(cls, code, subtotal):
+        """SQL conditions matching code only while it is valid for subtotal"""
+        return (
+            cls.code == code,
+            cls.is_active.is_(True),
+            cls.min_order_amount <= subtotal,
+            or_(cls.usage_limit.is_(None), cls.usage_limit == 0, cls.used_count < cls.usage_limit),
+            or_(cls.expires_at.is_(None), cls.expires_at >= get_ist_now())
+        )
+
+    @classmethod
+    def claim(cls, code, subtotal):
+        """Use up one redemption of a valid code in a single conditional UPDATE
+
+        Returns the promotion, or None when the code does not exist or is not
+        valid for this subtotal. Concurrent checkouts cannot both take the
+        last use, since the usage check and the increment are one statement.
+        The change is left in the caller's transaction.
+        """
+        stmt = (
+            update(cls)
+            .where(*cls.redeemable(code, subtotal))
+            .values(used_count=cls.used_count + 1)
+            .returning(cls)
+        )
+        return db.session.execute(stmt).scalar_one_or_none()
 
     def __repr__(self):
         return f'<Promotion {self.code}>'
 
+# Newest-first scan of active promotions for the checkout list
+db.Index('ix_promotion_active_created', Promotion.created_at.desc(),
+         sqlite_where=Promotion.is_active == True,
+         postgresql_where=Promotion.is_active == True)
+
 class Category(db.Model):
     __tablename__ = 'category'
     id = db.Column(db.Integer, primary_key=True)
@@ -1,34 +1,81 @@
 
-from flask import render_template, request, redirect, url_for, session, flash, jsonify
-from datetime import datetime
-import pytz
+from functools import wraps
+from flask import Blueprint, current_app, g, render_template, request, redirect, url_for, session, flash, jsonify
+from datetime import datetime, time, timedelta
+from sqlalchemy import case, insert, or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import lazyload, selectinload
 
-# Import app and db from the main app module
-from app import app, db
-from models import User, MenuItem, CartItem, Order, OrderItem, StoreSettings, Promotion
+from models import db, User, MenuItem, CartItem, Order, OrderItem, StoreSettings, Promotion, IST, get_ist_now
 from utils import (
     is_store_open, get_current_user, get_cart_items, get_cart_total, 
-    get_cart_count, clear_user_cart, validate_phone, validate_email,
+    get_cart_count, refresh_cart_count, session_cart_count, MAX_CART_QUANTITY,
+    upsert_cart_item, clear_user_cart, clean_phone, validate_phone, validate_email,
     find_user_by_login, apply_coupon, get_popular_items, get_categories,
     generate_qr_code, get_order_progress_percentage, calculate_delivery_charges,
-    get_ist_time, format_ist_datetime
+    get_ist_time, format_ist_datetime, invalidate_menu_cache,
+    get_available_promotions, invalidate_promotion_cache
 )
 
-@app.context_processor
+bp = Blueprint('main', __name__)
+
+# Rows per page on the order, user and menu listings
+PER_PAGE = 50
+
+# Orders the customer is still waiting on
+ACTIVE_ORDER_STATUSES = ('pending', 'confirmed', 'preparing', 'out_for_delivery')
+
+def paginate(query):
+    """Paginate a query by the ?page= argument"""
+    return query.paginate(page=request.args.get('page', 1, type=int), per_page=PER_PAGE)
+
+def require_role(role, login_message, denied_message='Access denied'):
+    """Restrict a view to one active user role, checked against the database
+
+    The user is loaded once per request through get_current_user(). A session
+    whose account was deactivated, deleted or given another role since login
+    is cleared, so demotions apply immediately.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if 'user_id' not in session:
+                flash(login_message, 'warning')
+                return redirect(url_for('main.login'))
+            
+            user = get_current_user()
+            if not user or not user.is_active or user.role != session.get('user_role'):
+                session.clear()
+                flash(login_message, 'warning')
+                return redirect(url_for('main.login'))
+            
+            if user.role != role:
+                flash(denied_message, 'error')
+                return redirect(url_for('main.home'))
+            
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
+admin_required = require_role('admin', 'Please log in as admin')
+delivery_required = require_role('delivery', 'Please log in as delivery person',
+                                 'Access denied - Delivery personnel only')
+
+@bp.app_context_processor
 def inject_globals():
-    """Inject global variables into all templates"""
-    ist_timezone = pytz.timezone('Asia/Kolkata')
-    current_ist = datetime.now(ist_timezone)
-    return {
-        'store_open': is_store_open(),
-        'get_current_user': get_current_user,
-        'cart_count': get_cart_count(),
-        'current_year': datetime.now().year,
-        'get_order_progress_percentage': get_order_progress_percentage,
-        'current_ist': current_ist
-    }
+    """Inject global variables into all templates (computed once per request)"""
+    template_globals = g.get('template_globals')
+    if template_globals is None:
+        template_globals = g.template_globals = {
+            'store_open': is_store_open(),
+            'get_current_user': get_current_user,
+            'cart_count': session_cart_count(),
+            'current_year': datetime.now().year,
+            'get_order_progress_percentage': get_order_progress_percentage
+        }
+    return template_globals
 
-@app.route('/')
+@bp.route('/')
 def home():
     """Home page with popular items and categories"""
     popular_items = get_popular_items(6)
@@ -38,7 +85,7 @@ def home():
                          menu_items=popular_items,
                          categories=categories)
 
-@app.route('/menu')
+@bp.route('/menu')
 def menu():
     """Menu page with filtering and search"""
     search_term = request.args.get('search', '').strip()
@@ -65,63 +112,45 @@ def menu():
                          search_term=search_term,
                          current_category=category_filter)
 
-@app.route('/add_to_cart', methods=['POST'])
+@bp.route('/add_to_cart', methods=['POST'])
 def add_to_cart():
     """Add item to cart (requires login)"""
     if 'user_id' not in session:
         flash('Please log in to add items to cart', 'warning')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     if not is_store_open():
         flash('Sorry, we are currently closed', 'error')
-        return redirect(url_for('menu'))
+        return redirect(url_for('main.menu'))
     
     item_id = request.form.get('item_id')
     quantity = int(request.form.get('quantity', 1))
     
     # Validate quantity
-    if quantity < 1 or quantity > 10:
+    if quantity < 1 or quantity > MAX_CART_QUANTITY:
         flash('Invalid quantity', 'error')
-        return redirect(url_for('menu'))
+        return redirect(url_for('main.menu'))
     
     # Check if item exists
-    menu_item = MenuItem.query.get(item_id)
+    menu_item = db.session.get(MenuItem, item_id)
     if not menu_item or not menu_item.in_stock:
         flash('Item not available', 'error')
-        return redirect(url_for('menu'))
-    
-    # Check if item already in cart
-    existing_item = CartItem.query.filter_by(
-        user_id=session['user_id'],
-        menu_item_id=item_id
-    ).first()
-    
-    if existing_item:
-        # Update quantity
-        existing_item.quantity += quantity
-        if existing_item.quantity > 10:
-            existing_item.quantity = 10
-    else:
-        # Add new item
-        cart_item = CartItem(
-            user_id=session['user_id'],
-            menu_item_id=item_id,
-            quantity=quantity
-        )
-        db.session.add(cart_item)
+        return redirect(url_for('main.menu'))
     
+    # Add the item, or top up the quantity if it is already in the cart
+    upsert_cart_item(session['user_id'], menu_item.id, quantity)
     db.session.commit()
+    refresh_cart_count()
     flash(f'{menu_item.name} added to cart!', 'success')
-    return redirect(url_for('menu'))
+    return redirect(url_for('main.menu'))
 
-@app.route('/cart')
+@bp.route('/cart')
 def cart():
     """Shopping cart page"""
     if 'user_id' not in session:
         return render_template('cart.html', cart_items=[], subtotal=0, total=0, discount=0)
     
-    cart_items = get_cart_items()
-    subtotal = sum(item['total'] for item in cart_items)
+    cart_items, subtotal = get_cart_items()
     discount = 0  # Can be calculated based on coupons
     total = subtotal - discount
     
@@ -131,62 +160,62 @@ def cart():
                          discount=discount,
                          total=total)
 
-@app.route('/update_cart', methods=['POST'])
+@bp.route('/update_cart', methods=['POST'])
 def update_cart():
     """Update cart item quantity"""
     if 'user_id' not in session:
         flash('Please log in first', 'warning')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     item_id = request.form.get('item_id')
     quantity = int(request.form.get('quantity', 0))
     
-    # Find cart item
+    # Change the cart row in place, without loading it first
     cart_item = CartItem.query.filter_by(
         user_id=session['user_id'],
         menu_item_id=item_id
-    ).first()
+    )
     
-    if cart_item:
-        if quantity <= 0:
-            # Remove item
-            db.session.delete(cart_item)
+    if quantity <= 0:
+        # Remove item
+        if cart_item.delete(synchronize_session=False):
             flash('Item removed from cart', 'info')
-        else:
-            # Update quantity
-            cart_item.quantity = min(quantity, 10)
+    else:
+        # Update quantity
+        if cart_item.update({CartItem.quantity: min(quantity, MAX_CART_QUANTITY)}, synchronize_session=False):
             flash('Cart updated', 'success')
-        
-        db.session.commit()
     
-    return redirect(url_for('cart'))
+    db.session.commit()
+    refresh_cart_count()
+    
+    return redirect(url_for('main.cart'))
 
-@app.route('/clear_cart')
+@bp.route('/clear_cart')
 def clear_cart():
     """Clear all items from cart"""
     if 'user_id' in session:
         clear_user_cart(session['user_id'])
+        session['cart_count'] = 0
         flash('Cart cleared', 'info')
     
-    return redirect(url_for('cart'))
+    return redirect(url_for('main.cart'))
 
-@app.route('/checkout')
+@bp.route('/checkout')
 def checkout():
     """Checkout page - supports guest checkout"""
     cart_items = []
     subtotal = 0
     
     if 'user_id' in session:
-        cart_items = get_cart_items()
-        subtotal = sum(item['total'] for item in cart_items)
+        cart_items, subtotal = get_cart_items()
     
     if not cart_items:
         flash('Your cart is empty', 'warning')
-        return redirect(url_for('menu'))
+        return redirect(url_for('main.menu'))
     
     if not is_store_open():
         flash('Sorry, we are currently closed', 'error')
-        return redirect(url_for('cart'))
+        return redirect(url_for('main.cart'))
     
     # Calculate delivery charges
     delivery_charges = calculate_delivery_charges(subtotal)
@@ -197,9 +226,7 @@ def checkout():
     total = subtotal + delivery_charges - discount
     
     # Get available promotions for display
-    available_promotions = Promotion.query.filter_by(is_active=True).filter(
-        Promotion.expires_at.is_(None) | (Promotion.expires_at > datetime.utcnow())
-    ).limit(8).all()
+    available_promotions = get_available_promotions()
     
     return render_template('checkout.html',
                          cart_items=cart_items,
@@ -210,12 +237,12 @@ def checkout():
                          coupon_code=coupon_code,
                          available_promotions=available_promotions)
 
-@app.route('/checkout', methods=['POST'])
+@bp.route('/checkout', methods=['POST'])
 def process_checkout():
     """Process checkout and create order"""
     if not is_store_open():
         flash('Sorry, we are currently closed', 'error')
-        return redirect(url_for('cart'))
+        return redirect(url_for('main.cart'))
     
     # Get form data
     customer_name = request.form.get('customer_name', '').strip()
@@ -227,104 +254,111 @@ def process_checkout():
     # Validation
     if not all([customer_name, customer_phone, customer_address]):
         flash('Please fill in all required fields', 'error')
-        return redirect(url_for('checkout'))
+        return redirect(url_for('main.checkout'))
     
     if not validate_phone(customer_phone):
         flash('Please enter a valid phone number', 'error')
-        return redirect(url_for('checkout'))
+        return redirect(url_for('main.checkout'))
     
     # Get cart items
-    cart_items = []
+    cart_items, subtotal = [], 0
     user_id = session.get('user_id')
     
     if user_id:
-        cart_items = get_cart_items(user_id)
+        cart_items, subtotal = get_cart_items(user_id)
     
     if not cart_items:
         flash('Your cart is empty', 'warning')
-        return redirect(url_for('menu'))
+        return redirect(url_for('main.menu'))
     
     # Calculate totals
-    subtotal = sum(item['total'] for item in cart_items)
     delivery_charges = calculate_delivery_charges(subtotal)
-    discount = 0
-    
-    # Validate and apply coupon
-    if coupon_code:
-        promotion = Promotion.query.filter_by(code=coupon_code.upper().strip()).first()
-        if promotion and promotion.is_valid and subtotal >= promotion.min_order_amount:
-            discount = promotion.calculate_discount(subtotal)
-            # Mark coupon as used
-            promotion.use_promotion()
-        else:
-            # Invalid coupon, redirect back with error
-            flash('Invalid or expired coupon code', 'error')
-            return redirect(url_for('checkout'))
-    
-    total = subtotal + delivery_charges - discount
     
     try:
-        # Create order
-        order = Order(
-            user_id=user_id,
-            customer_name=customer_name,
-            customer_phone=customer_phone,
-            customer_address=customer_address,
-            subtotal=subtotal,
-            delivery_charges=delivery_charges,
-            discount=discount,
-            total_amount=total,
-            payment_method=payment_method,
-            coupon_code=coupon_code if coupon_code else None,
-            order_number=Order.generate_order_number()
-        )
-        
-        # Add guest info if not logged in
-        if not user_id:
-            order.guest_name = customer_name
-            order.guest_phone = customer_phone
-        
-        db.session.add(order)
-        db.session.flush()  # Get order ID
-        
-        # Create order items
-        for cart_item in cart_items:
-            order_item = OrderItem(
-                order_id=order.id,
-                menu_item_id=cart_item['id'],
-                quantity=cart_item['quantity'],
-                unit_price=cart_item['price'],
-                total_price=cart_item['total']
+        # Create order, retrying with a fresh order number on the rare collision
+        for attempt in range(3):
+            # Validate and use the coupon in one UPDATE; this sits inside the
+            # loop because a collision rollback also undoes the claim
+            discount = 0
+            if coupon_code:
+                promotion = Promotion.claim(coupon_code.upper().strip(), subtotal)
+                if promotion is None:
+                    # Invalid coupon, redirect back with error
+                    flash('Invalid or expired coupon code', 'error')
+                    return redirect(url_for('main.checkout'))
+                discount = promotion.discount_amount(subtotal)
+            
+            total = subtotal + delivery_charges - discount
+            order = Order(
+                user_id=user_id,
+                customer_name=customer_name,
+                customer_phone=customer_phone,
+                customer_address=customer_address,
+                subtotal=subtotal,
+                delivery_charges=delivery_charges,
+                discount=discount,
+                total_amount=total,
+                payment_method=payment_method,
+                coupon_code=coupon_code if coupon_code else None,
+                order_number=Order.generate_order_number()
             )
-            db.session.add(order_item)
+            
+            # Add guest info if not logged in
+            if not user_id:
+                order.guest_name = customer_name
+                order.guest_phone = customer_phone
+            
+            db.session.add(order)
+            try:
+                db.session.flush()  # Get order ID
+                break
+            except IntegrityError:
+                db.session.rollback()
+                if attempt == 2:
+                    raise
+        
+        # Create order items with a single multi-row INSERT
+        db.session.execute(insert(OrderItem), [
+            {
+                'order_id': order.id,
+                'menu_item_id': cart_item['id'],
+                'quantity': cart_item['quantity'],
+                'unit_price': cart_item['price'],
+                'total_price': cart_item['total']
+            }
+            for cart_item in cart_items
+        ])
         
         # Clear cart if user is logged in
         if user_id:
-            clear_user_cart(user_id)
+            clear_user_cart(user_id, commit=False)
+        
+        # Cash on delivery - mark as confirmed in the same transaction
+        if payment_method != 'upi':
+            order.payment_status = 'confirmed'
+            order.confirmed_at = datetime.utcnow()
         
         db.session.commit()
+        if user_id:
+            session['cart_count'] = 0
         
         # Redirect based on payment method
         if payment_method == 'upi':
-            return redirect(url_for('upi_payment', order_id=order.id))
+            return redirect(url_for('main.upi_payment', order_id=order.id))
         else:
-            # Cash on delivery - mark as confirmed
-            order.payment_status = 'confirmed'
-            order.confirmed_at = datetime.utcnow()
-            db.session.commit()
             flash('Order placed successfully!', 'success')
-            return redirect(url_for('order_confirmation', order_id=order.id))
+            return redirect(url_for('main.order_confirmation', order_id=order.id))
             
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"Checkout error: {e}")
+        current_app.logger.error(f"Checkout error: {e}")
         flash('An error occurred while processing your order. Please try again.', 'error')
-        return redirect(url_for('checkout'))
+        return redirect(url_for('main.checkout'))
 
-@app.route('/upi_payment/<int:order_id>')
+@bp.route('/upi_payment/<int:order_id>')
 def upi_payment(order_id):
     """UPI payment page with QR code"""
-    order = Order.query.get_or_404(order_id)
+    order = db.get_or_404(Order, order_id)
     
     # Generate QR code for payment
     qr_code = generate_qr_code(order.order_number, order.total_amount)
@@ -333,10 +367,10 @@ def upi_payment(order_id):
                          order=order,
                          qr_code=qr_code)
 
-@app.route('/confirm_payment/<int:order_id>', methods=['POST'])
+@bp.route('/confirm_payment/<int:order_id>', methods=['POST'])
 def confirm_payment(order_id):
     """Confirm UPI payment"""
-    order = Order.query.get_or_404(order_id)
+    order = db.get_or_404(Order, order_id)
     
     # Update order status
     order.payment_status = 'confirmed'
@@ -344,30 +378,38 @@ def confirm_payment(order_id):
     db.session.commit()
     
     flash('Payment confirmed! Your order is being prepared.', 'success')
-    return redirect(url_for('order_confirmation', order_id=order.id))
+    return redirect(url_for('main.order_confirmation', order_id=order.id))
 
-@app.route('/order_confirmation/<int:order_id>')
+@bp.route('/order_confirmation/<int:order_id>')
 def order_confirmation(order_id):
     """Order confirmation page"""
-    order = Order.query.get_or_404(order_id)
+    order = db.get_or_404(Order, order_id, options=[
+        selectinload(Order.order_items).joinedload(OrderItem.menu_item)
+    ])
     return render_template('order_confirmation.html', order=order)
 
-@app.route('/my_orders')
+@bp.route('/my_orders')
 def my_orders():
     """User's order history (requires login)"""
     if 'user_id' not in session:
         flash('Please log in to view your orders', 'warning')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
-    orders = Order.query.filter_by(user_id=session['user_id']).order_by(Order.created_at.desc()).all()
+    query = Order.query.filter_by(user_id=session['user_id'])
+    pagination = paginate(
+        query.options(selectinload(Order.order_items).joinedload(OrderItem.menu_item))
+        .order_by(Order.created_at.desc())
+    )
+    # Across all pages, for the page title
+    active_orders_count = query.filter(Order.status.in_(ACTIVE_ORDER_STATUSES)).count()
     
     # Get current IST time for last updated
-    ist_timezone = pytz.timezone('Asia/Kolkata')
-    current_ist = datetime.now(ist_timezone)
+    current_ist = datetime.now(IST)
     
-    return render_template('my_orders.html', orders=orders, current_ist=current_ist)
+    return render_template('my_orders.html', orders=pagination.items, pagination=pagination,
+                         active_orders_count=active_orders_count, current_ist=current_ist)
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     """Login page - supports username or phone number"""
     if request.method == 'POST':
@@ -386,6 +428,7 @@ def login():
             session['user_id'] = user.id
             session['username'] = user.username
             session['user_role'] = user.role
+            refresh_cart_count()
             
             flash(f'Welcome back, {user.full_name or user.username}!', 'success')
             
@@ -393,23 +436,23 @@ def login():
             if next_page:
                 return redirect(next_page)
             elif user.is_admin():
-                return redirect(url_for('admin'))
+                return redirect(url_for('main.admin'))
             elif user.is_delivery_person():
-                return redirect(url_for('delivery_dashboard'))
+                return redirect(url_for('main.delivery_dashboard'))
             else:
-                return redirect(url_for('home'))
+                return redirect(url_for('main.home'))
         else:
             flash('Invalid username/phone or password', 'error')
     
     next_page = request.args.get('next')
     return render_template('login.html', next=next_page)
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     """User registration"""
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
-        email = request.form.get('email', '').strip()
+        email = request.form.get('email', '').strip().lower()
         password = request.form.get('password', '')
         confirm_password = request.form.get('confirm_password', '')
         full_name = request.form.get('full_name', '').strip()
@@ -433,14 +476,22 @@ def register():
         if phone and not validate_phone(phone):
             errors.append('Please enter a valid phone number')
         
-        # Check if username or email already exists
-        if User.query.filter_by(username=username).first():
+        # Store (and compare) phone numbers as digits only
+        phone = clean_phone(phone)
+        
+        # Check if username, email or phone already exists (one query)
+        conflicts = [db.func.lower(User.username) == username.lower(), db.func.lower(User.email) == email]
+        if phone:
+            conflicts.append(User.phone == phone)
+        existing_users = db.session.query(User.username, User.email, User.phone).filter(or_(*conflicts)).all()
+        
+        if any(existing.username.lower() == username.lower() for existing in existing_users):
             errors.append('Username already exists')
         
-        if User.query.filter_by(email=email).first():
+        if any(existing.email.lower() == email for existing in existing_users):
             errors.append('Email already registered')
         
-        if phone and User.query.filter_by(phone=phone).first():
+        if phone and any(existing.phone == phone for existing in existing_users):
             errors.append('Phone number already registered')
         
         if errors:
@@ -454,7 +505,7 @@ def register():
                 username=username,
                 email=email,
                 full_name=full_name,
-                phone=phone.replace(' ', '').replace('-', '') if phone else None
+                phone=phone or None
             )
             user.set_password(password)
             
@@ -462,39 +513,37 @@ def register():
             db.session.commit()
             
             flash('Registration successful! Please log in.', 'success')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
             
         except Exception as e:
             db.session.rollback()
-            app.logger.error(f"Registration error: {e}")
+            current_app.logger.error(f"Registration error: {e}")
             flash('An error occurred during registration. Please try again.', 'error')
     
     return render_template('register.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Logout user"""
     session.clear()
     flash('You have been logged out', 'info')
-    return redirect(url_for('home'))
+    return redirect(url_for('main.home'))
 
-@app.route('/admin')
+@bp.route('/admin')
+@admin_required
 def admin():
     """Admin dashboard"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
-    
-    # Get dashboard statistics
-    total_orders = Order.query.count()
-    pending_orders = Order.query.filter_by(status='pending').count()
-    today_orders = Order.query.filter(Order.created_at >= datetime.now().date()).count()
-    total_revenue = db.session.query(db.func.sum(Order.total_amount)).filter_by(payment_status='confirmed').scalar() or 0
+    # Today's orders as a half-open [start, end) range of IST timestamps
+    today_start = datetime.combine(datetime.now(IST).date(), time.min)
+    today_end = today_start + timedelta(days=1)
+    
+    # Get dashboard statistics in a single pass over orders
+    total_orders, pending_orders, today_orders, total_revenue = db.session.query(
+        db.func.count(Order.id),
+        db.func.count(case((Order.status == 'pending', 1))),
+        db.func.count(case(((Order.created_at >= today_start) & (Order.created_at < today_end), 1))),
+        db.func.coalesce(db.func.sum(case((Order.payment_status == 'confirmed', Order.total_amount))), 0)
+    ).one()
     
     # Recent orders
     recent_orders = Order.query.order_by(Order.created_at.desc()).limit(10).all()
@@ -506,18 +555,10 @@ def admin():
                          total_revenue=total_revenue,
                          recent_orders=recent_orders)
 
-@app.route('/admin/toggle_store', methods=['POST'])
+@bp.route('/admin/toggle_store', methods=['POST'])
+@admin_required
 def toggle_store():
     """Toggle store open/close status"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
-    
     current_status = is_store_open()
     new_status = 'false' if current_status else 'true'
     
@@ -526,20 +567,12 @@ def toggle_store():
     status_text = 'opened' if new_status == 'true' else 'closed'
     flash(f'Store has been {status_text}', 'success')
     
-    return redirect(url_for('admin'))
+    return redirect(url_for('main.admin'))
 
-@app.route('/admin/orders')
+@bp.route('/admin/orders')
+@admin_required
 def admin_orders():
     """Admin orders management"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
-    
     status_filter = request.args.get('status', 'all')
     
     # Base query
@@ -548,26 +581,21 @@ def admin_orders():
     if status_filter != 'all':
         query = query.filter_by(status=status_filter)
     
-    orders = query.order_by(Order.created_at.desc()).all()
+    pagination = paginate(query.order_by(Order.created_at.desc()))
+    # Across all pages, for the new-order title alert
+    pending_count = query.filter(Order.status == 'pending').count()
     
-    return render_template('admin_orders.html', orders=orders, status_filter=status_filter)
+    return render_template('admin_orders.html', orders=pagination.items, pagination=pagination,
+                         pending_count=pending_count, status_filter=status_filter)
 
-@app.route('/admin/update_order_status', methods=['POST'])
+@bp.route('/admin/update_order_status', methods=['POST'])
+@admin_required
 def update_order_status():
     """Update order status"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
-    
     order_id = request.form.get('order_id')
     new_status = request.form.get('status')
     
-    order = Order.query.get_or_404(order_id)
+    order = db.get_or_404(Order, order_id)
     order.status = new_status
     
     if new_status == 'delivered':
@@ -576,21 +604,13 @@ def update_order_status():
     db.session.commit()
     
     flash(f'Order {order.order_number} status updated to {new_status}', 'success')
-    return redirect(url_for('admin_orders'))
+    return redirect(url_for('main.admin_orders'))
 
 # User Management Routes
-@app.route('/admin/users')
+@bp.route('/admin/users')
+@admin_required
 def admin_users():
     """Admin user management"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
-    
     # Get all users with filtering
     role_filter = request.args.get('role', 'all')
     status_filter = request.args.get('status', 'all')
@@ -605,52 +625,45 @@ def admin_users():
     elif status_filter == 'inactive':
         query = query.filter_by(is_active=False)
     
-    users = query.order_by(User.created_at.desc()).all()
+    pagination = paginate(query.order_by(User.created_at.desc()))
     
     return render_template('admin_users.html', 
-                         users=users, 
+                         users=pagination.items,
+                         pagination=pagination, 
                          role_filter=role_filter,
                          status_filter=status_filter)
 
-@app.route('/admin/users/<int:user_id>/toggle_status', methods=['POST'])
+@bp.route('/admin/users/<int:user_id>/toggle_status', methods=['POST'])
+@admin_required
 def toggle_user_status(user_id):
     """Toggle user active/inactive status"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
     current_user = get_current_user()
-    if not current_user or not current_user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
+    if not current_user:
+        return redirect(url_for('main.login'))
     
-    user_to_toggle = User.query.get_or_404(user_id)
+    user_to_toggle = db.get_or_404(User, user_id)
     
     # Prevent admin from deactivating themselves
     if user_to_toggle.id == current_user.id:
         flash('You cannot deactivate your own account', 'error')
-        return redirect(url_for('admin_users'))
+        return redirect(url_for('main.admin_users'))
     
     user_to_toggle.is_active = not user_to_toggle.is_active
     db.session.commit()
     
     status_text = 'activated' if user_to_toggle.is_active else 'deactivated'
     flash(f'User {user_to_toggle.username} has been {status_text}', 'success')
-    return redirect(url_for('admin_users'))
+    return redirect(url_for('main.admin_users'))
 
-@app.route('/admin/users/<int:user_id>/edit', methods=['GET', 'POST'])
+@bp.route('/admin/users/<int:user_id>/edit', methods=['GET', 'POST'])
+@admin_required
 def edit_user(user_id):
     """Edit user details"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
     current_user = get_current_user()
-    if not current_user or not current_user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
+    if not current_user:
+        return redirect(url_for('main.login'))
     
-    user_to_edit = User.query.get_or_404(user_id)
+    user_to_edit = db.get_or_404(User, user_id)
     
     if request.method == 'POST':
         try:
@@ -664,28 +677,20 @@ def edit_user(user_id):
             
             db.session.commit()
             flash(f'User {user_to_edit.username} updated successfully', 'success')
-            return redirect(url_for('admin_users'))
+            return redirect(url_for('main.admin_users'))
             
         except Exception as e:
             db.session.rollback()
-            app.logger.error(f"User edit error: {e}")
+            current_app.logger.error(f"User edit error: {e}")
             flash('Error updating user. Please try again.', 'error')
     
     return render_template('admin_edit_user.html', user_to_edit=user_to_edit)
 
 # Menu Management Routes
-@app.route('/admin/menu')
+@bp.route('/admin/menu')
+@admin_required
 def admin_menu():
     """Admin menu management"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
-    
     # Get all menu items
     category_filter = request.args.get('category', 'all')
     status_filter = request.args.get('status', 'all')
@@ -700,47 +705,33 @@ def admin_menu():
     elif status_filter == 'unavailable':
         query = query.filter_by(in_stock=False)
     
-    menu_items = query.order_by(MenuItem.category, MenuItem.name).all()
+    pagination = paginate(query.order_by(MenuItem.category, MenuItem.name))
     categories = get_categories()
     
     return render_template('admin_menu.html', 
-                         menu_items=menu_items,
+                         menu_items=pagination.items,
+                         pagination=pagination,
                          categories=categories,
                          category_filter=category_filter,
                          status_filter=status_filter)
 
-@app.route('/admin/menu/<int:item_id>/toggle_stock', methods=['POST'])
+@bp.route('/admin/menu/<int:item_id>/toggle_stock', methods=['POST'])
+@admin_required
 def toggle_menu_item_stock(item_id):
     """Toggle menu item in_stock status"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
-    
-    menu_item = MenuItem.query.get_or_404(item_id)
+    menu_item = db.get_or_404(MenuItem, item_id)
     menu_item.in_stock = not menu_item.in_stock
     db.session.commit()
+    invalidate_menu_cache()
     
     status_text = 'listed' if menu_item.in_stock else 'delisted'
     flash(f'{menu_item.name} has been {status_text}', 'success')
-    return redirect(url_for('admin_menu'))
+    return redirect(url_for('main.admin_menu'))
 
-@app.route('/admin/menu/add', methods=['GET', 'POST'])
+@bp.route('/admin/menu/add', methods=['GET', 'POST'])
+@admin_required
 def add_menu_item():
     """Add new menu item"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
-    
     if request.method == 'POST':
         try:
             new_item = MenuItem(
@@ -755,31 +746,24 @@ def add_menu_item():
             
             db.session.add(new_item)
             db.session.commit()
+            invalidate_menu_cache()
             
             flash(f'{new_item.name} added to menu successfully', 'success')
-            return redirect(url_for('admin_menu'))
+            return redirect(url_for('main.admin_menu'))
             
         except Exception as e:
             db.session.rollback()
-            app.logger.error(f"Add menu item error: {e}")
+            current_app.logger.error(f"Add menu item error: {e}")
             flash('Error adding menu item. Please try again.', 'error')
     
     categories = get_categories()
     return render_template('admin_add_menu_item.html', categories=categories)
 
-@app.route('/admin/menu/<int:item_id>/edit', methods=['GET', 'POST'])
+@bp.route('/admin/menu/<int:item_id>/edit', methods=['GET', 'POST'])
+@admin_required
 def edit_menu_item(item_id):
     """Edit menu item"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
-    
-    menu_item = MenuItem.query.get_or_404(item_id)
+    menu_item = db.get_or_404(MenuItem, item_id)
     
     if request.method == 'POST':
         try:
@@ -790,30 +774,23 @@ def edit_menu_item(item_id):
             menu_item.emoji = request.form.get('emoji', '')
             
             db.session.commit()
+            invalidate_menu_cache()
             flash(f'{menu_item.name} updated successfully', 'success')
-            return redirect(url_for('admin_menu'))
+            return redirect(url_for('main.admin_menu'))
             
         except Exception as e:
             db.session.rollback()
-            app.logger.error(f"Edit menu item error: {e}")
+            current_app.logger.error(f"Edit menu item error: {e}")
             flash('Error updating menu item. Please try again.', 'error')
     
     categories = get_categories()
     return render_template('admin_edit_menu_item.html', menu_item=menu_item, categories=categories)
 
 # Promotion Management Routes
-@app.route('/admin/promotions')
+@bp.route('/admin/promotions')
+@admin_required
 def admin_promotions():
     """Admin promotion management"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
-    
     # Get all promotions
     status_filter = request.args.get('status', 'all')
     
@@ -832,25 +809,16 @@ def admin_promotions():
                          promotions=promotions,
                          status_filter=status_filter)
 
-@app.route('/admin/promotions/add', methods=['GET', 'POST'])
+@bp.route('/admin/promotions/add', methods=['GET', 'POST'])
+@admin_required
 def add_promotion():
     """Add new promotion"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
-    
     if request.method == 'POST':
         try:
             code = request.form.get('code', '').upper().strip()
             
             # Check if code already exists
-            existing = Promotion.query.filter_by(code=code).first()
-            if existing:
+            if db.session.query(Promotion.id).filter_by(code=code).first() is not None:
                 flash('Promotion code already exists', 'error')
                 return render_template('admin_add_promotion.html')
             
@@ -872,30 +840,23 @@ def add_promotion():
             
             db.session.add(new_promotion)
             db.session.commit()
+            invalidate_promotion_cache()
             
             flash(f'Promotion {new_promotion.code} created successfully', 'success')
-            return redirect(url_for('admin_promotions'))
+            return redirect(url_for('main.admin_promotions'))
             
         except Exception as e:
             db.session.rollback()
-            app.logger.error(f"Add promotion error: {e}")
+            current_app.logger.error(f"Add promotion error: {e}")
             flash('Error creating promotion. Please try again.', 'error')
     
     return render_template('admin_add_promotion.html')
 
-@app.route('/admin/promotions/<int:promotion_id>/edit', methods=['GET', 'POST'])
+@bp.route('/admin/promotions/<int:promotion_id>/edit', methods=['GET', 'POST'])
+@admin_required
 def edit_promotion(promotion_id):
     """Edit promotion"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
-    
-    promotion = Promotion.query.get_or_404(promotion_id)
+    promotion = db.get_or_404(Promotion, promotion_id)
     
     if request.method == 'POST':
         try:
@@ -912,12 +873,13 @@ def edit_promotion(promotion_id):
                 promotion.expires_at = None
             
             db.session.commit()
+            invalidate_promotion_cache()
             flash(f'Promotion {promotion.code} updated successfully', 'success')
-            return redirect(url_for('admin_promotions'))
+            return redirect(url_for('main.admin_promotions'))
             
         except Exception as e:
             db.session.rollback()
-            app.logger.error(f"Edit promotion error: {e}")
+            current_app.logger.error(f"Edit promotion error: {e}")
             flash('Error updating promotion. Please try again.', 'error')
     
     return render_template('admin_edit_promotion.html', promotion=promotion)
@@ -926,34 +888,38 @@ def edit_promotion(promotion_id):
 # DELIVERY PERSON ROUTES
 # =============================================================================
 
-@app.route('/delivery')
+@bp.route('/delivery')
+@delivery_required
 def delivery_dashboard():
     """Delivery person dashboard"""
-    if 'user_id' not in session:
-        flash('Please log in as delivery person', 'warning')
-        return redirect(url_for('login'))
+    delivery_person_id = session['user_id']
     
-    user = get_current_user()
-    if not user or not user.is_delivery_person():
-        flash('Access denied - Delivery personnel only', 'error')
-        return redirect(url_for('home'))
+    # The dashboard shows customer names but never the item lines, so load
+    # each batch's users in one IN query and skip the order_items selectin
+    dashboard_options = (selectinload(Order.user), lazyload(Order.order_items))
     
     # Get orders assigned to this delivery person
-    assigned_orders = Order.query.filter_by(delivery_person_id=user.id).order_by(Order.created_at.desc()).all()
+    assigned_orders = Order.query.options(*dashboard_options).filter_by(
+        delivery_person_id=delivery_person_id
+    ).order_by(Order.created_at.desc()).all()
     
     # Get orders ready for delivery (confirmed/preparing status) that are unassigned
-    available_orders = Order.query.filter(
+    available_orders = Order.query.options(*dashboard_options).filter(
         Order.status.in_(['confirmed', 'preparing']),
         Order.delivery_person_id.is_(None)
     ).order_by(Order.created_at.asc()).all()
     
-    # Get dashboard statistics
+    # Get dashboard statistics; today is a half-open [start, end) range of IST
+    # timestamps so the delivery lookup index covers the whole filter
     total_assigned = len(assigned_orders)
-    delivered_today = Order.query.filter(
-        Order.delivery_person_id == user.id,
+    today_start = datetime.combine(datetime.now(IST).date(), time.min)
+    today_end = today_start + timedelta(days=1)
+    delivered_today = db.session.query(db.func.count(Order.id)).filter(
+        Order.delivery_person_id == delivery_person_id,
         Order.status == 'delivered',
-        Order.delivery_time >= datetime.now().date()
-    ).count()
+        Order.delivery_time >= today_start,
+        Order.delivery_time < today_end
+    ).scalar()
     
     return render_template('delivery_dashboard.html',
                          assigned_orders=assigned_orders,
@@ -961,130 +927,111 @@ def delivery_dashboard():
                          total_assigned=total_assigned,
                          delivered_today=delivered_today)
 
-@app.route('/delivery/assign/<int:order_id>')
+@bp.route('/delivery/assign/<int:order_id>')
+@delivery_required
 def assign_order(order_id):
     """Assign an order to the current delivery person"""
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
+    delivery_person_id = session['user_id']
     
-    user = get_current_user()
-    if not user or not user.is_delivery_person():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
-    
-    order = Order.query.get_or_404(order_id)
+    order = db.get_or_404(Order, order_id)
     
     if order.delivery_person_id:
         flash('Order already assigned to another delivery person', 'warning')
     else:
-        order.delivery_person_id = user.id
+        order.delivery_person_id = delivery_person_id
         if order.status == 'confirmed':
             order.status = 'preparing'
         
         db.session.commit()
         flash(f'Order #{order.order_number} assigned to you', 'success')
     
-    return redirect(url_for('delivery_dashboard'))
+    return redirect(url_for('main.delivery_dashboard'))
 
-@app.route('/delivery/pickup/<int:order_id>')
+@bp.route('/delivery/pickup/<int:order_id>')
+@delivery_required
 def pickup_order(order_id):
     """Mark order as picked up (out for delivery)"""
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_delivery_person():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
+    delivery_person_id = session['user_id']
     
-    order = Order.query.get_or_404(order_id)
+    order = db.get_or_404(Order, order_id)
     
-    if order.delivery_person_id != user.id:
+    if order.delivery_person_id != delivery_person_id:
         flash('You can only pick up orders assigned to you', 'error')
     else:
         order.status = 'out_for_delivery'
         db.session.commit()
         flash(f'Order #{order.order_number} marked as out for delivery', 'success')
     
-    return redirect(url_for('delivery_dashboard'))
+    return redirect(url_for('main.delivery_dashboard'))
 
-@app.route('/delivery/complete/<int:order_id>')
+@bp.route('/delivery/complete/<int:order_id>')
+@delivery_required
 def complete_delivery(order_id):
     """Mark order as delivered"""
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_delivery_person():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
+    delivery_person_id = session['user_id']
     
-    order = Order.query.get_or_404(order_id)
+    # Neither the customer nor the item lines are needed here
+    order = db.get_or_404(Order, order_id, options=[
+        lazyload(Order.user), lazyload(Order.order_items)
+    ])
     
-    if order.delivery_person_id != user.id:
+    if order.delivery_person_id != delivery_person_id:
         flash('You can only deliver orders assigned to you', 'error')
     else:
-        from models import get_ist_now
         order.status = 'delivered'
         order.delivery_time = get_ist_now()
         order.payment_status = 'confirmed'  # Mark payment as confirmed on delivery
         
-        # Add loyalty points to user (if registered user)
+        # Add loyalty points to user (if registered user) with an in-database
+        # increment, so the customer row is never loaded
         if order.user_id:
-            customer = User.query.get(order.user_id)
-            if customer:
-                points_earned = int(order.total_amount // 10)  # 1 point per 10rs spent
-                customer.loyalty_points += points_earned
+            points_earned = int(order.total_amount // 10)  # 1 point per 10rs spent
+            db.session.execute(
+                update(User)
+                .where(User.id == order.user_id)
+                .values(loyalty_points=User.loyalty_points + points_earned)
+            )
         
         db.session.commit()
         flash(f'Order #{order.order_number} marked as delivered!', 'success')
     
-    return redirect(url_for('delivery_dashboard'))
+    return redirect(url_for('main.delivery_dashboard'))
 
 # =============================================================================
 # LOYALTY POINTS ROUTES
 # =============================================================================
 
-@app.route('/loyalty')
+@bp.route('/loyalty')
 def loyalty_dashboard():
     """Loyalty points dashboard for customers"""
     if 'user_id' not in session:
         flash('Please log in to view your loyalty points', 'warning')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     user = get_current_user()
     if not user:
         flash('User not found', 'error')
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     
     tier_info = user.get_loyalty_tier_info()
     redeemable_amount = user.get_redeemable_amount()
     
-    # Calculate points needed for next tier
-    next_tier_points = 0
-    if user.loyalty_tier == 'bronze':
-        next_tier_points = 1000 - user.loyalty_points
-    elif user.loyalty_tier == 'silver':
-        next_tier_points = 2500 - user.loyalty_points
-    elif user.loyalty_tier == 'gold':
-        next_tier_points = 5000 - user.loyalty_points
-    
     return render_template('loyalty_dashboard.html',
                          user=user,
                          tier_info=tier_info,
                          redeemable_amount=redeemable_amount,
-                         next_tier_points=max(0, next_tier_points))
+                         next_tier_points=user.get_points_to_next_tier())
 
-@app.route('/loyalty/redeem', methods=['POST'])
+@bp.route('/loyalty/redeem', methods=['POST'])
 def redeem_loyalty_points():
     """Redeem loyalty points for discount"""
     if 'user_id' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     user = get_current_user()
     if not user:
         flash('User not found', 'error')
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     
     try:
         points_to_redeem = int(request.form.get('points_to_redeem', 0))
@@ -1101,65 +1048,57 @@ def redeem_loyalty_points():
     except Exception as e:
         db.session.rollback()
         flash('Error processing redemption. Please try again.', 'error')
-        app.logger.error(f"Points redemption error: {e}")
+        current_app.logger.error(f"Points redemption error: {e}")
     
-    return redirect(url_for('loyalty_dashboard'))
+    return redirect(url_for('main.loyalty_dashboard'))
 
 
 
-@app.route('/admin/promotions/<int:promotion_id>/toggle_status', methods=['POST'])
+@bp.route('/admin/promotions/<int:promotion_id>/toggle_status', methods=['POST'])
+@admin_required
 def toggle_promotion_status(promotion_id):
     """Toggle promotion active/inactive status"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
-    
-    promotion = Promotion.query.get_or_404(promotion_id)
+    promotion = db.get_or_404(Promotion, promotion_id)
     promotion.is_active = not promotion.is_active
     db.session.commit()
+    invalidate_promotion_cache()
     
     status_text = 'activated' if promotion.is_active else 'deactivated'
     flash(f'Promotion {promotion.code} has been {status_text}', 'success')
-    return redirect(url_for('admin_promotions'))
+    return redirect(url_for('main.admin_promotions'))
 
-@app.route('/admin/promotions/<int:promotion_id>/delete', methods=['POST'])
+@bp.route('/admin/promotions/<int:promotion_id>/delete', methods=['POST'])
+@admin_required
 def delete_promotion(promotion_id):
     """Delete promotion"""
-    if 'user_id' not in session:
-        flash('Please log in as admin', 'warning')
-        return redirect(url_for('login'))
-    
-    user = get_current_user()
-    if not user or not user.is_admin():
-        flash('Access denied', 'error')
-        return redirect(url_for('home'))
-    
-    promotion = Promotion.query.get_or_404(promotion_id)
+    promotion = db.get_or_404(Promotion, promotion_id)
     code = promotion.code
     
     db.session.delete(promotion)
     db.session.commit()
+    invalidate_promotion_cache()
     
     flash(f'Promotion {code} has been deleted', 'success')
-    return redirect(url_for('admin_promotions'))
+    return redirect(url_for('main.admin_promotions'))
 
 # API Routes for AJAX calls (minimal usage as per guidelines)
 
-@app.route('/api/cart_count')
+@bp.route('/api/cart_count')
 def api_cart_count():
     """API endpoint for cart count"""
     count = get_cart_count()
     return jsonify({'count': count})
 
-@app.route('/api/order_status/<order_number>')
+@bp.route('/api/order_status/<order_number>')
 def api_order_status(order_number):
     """API endpoint for real-time order status"""
-    order = Order.query.filter_by(order_number=order_number).first_or_404()
+    # Count the item lines in the same query instead of loading them
+    items_count = db.session.query(db.func.count(OrderItem.id)).filter(
+        OrderItem.order_id == Order.id
+    ).scalar_subquery()
+    order, order_items_count = db.session.query(Order, items_count).options(
+        lazyload(Order.order_items), lazyload(Order.user)
+    ).filter(Order.order_number == order_number).first_or_404()
     
     return jsonify({
         'status': order.status,
@@ -1168,11 +1107,11 @@ def api_order_status(order_number):
         'payment_status': order.payment_status,
         'estimated_time': '30-45 minutes',
         'last_updated': order.created_at_ist.strftime('%I:%M %p IST'),
-        'order_items_count': len(order.order_items),
+        'order_items_count': order_items_count,
         'total_amount': order.total_amount
     })
 
-@app.route('/api/validate_coupon', methods=['POST'])
+@bp.route('/api/validate_coupon', methods=['POST'])
 def api_validate_coupon():
     """API endpoint for coupon validation"""
     try:
@@ -1186,16 +1125,19 @@ def api_validate_coupon():
                 'message': 'Please enter a coupon code'
             })
         
-        # Find promotion
-        promotion = Promotion.query.filter_by(code=coupon_code).first()
+        # Find promotion; it only matches while valid for this subtotal
+        promotion = Promotion.query.filter(*Promotion.redeemable(coupon_code, subtotal)).first()
         
         if not promotion:
-            return jsonify({
-                'valid': False,
-                'message': 'Coupon code not found'
-            })
-        
-        if not promotion.is_valid:
+            # Look the code up again only to explain why it was rejected
+            promotion = Promotion.query.filter_by(code=coupon_code).first()
+            
+            if not promotion:
+                return jsonify({
+                    'valid': False,
+                    'message': 'Coupon code not found'
+                })
+            
             if not promotion.is_active:
                 return jsonify({
                     'valid': False,
@@ -1211,14 +1153,18 @@ def api_validate_coupon():
                     'valid': False,
                     'message': 'This coupon has reached its usage limit'
                 })
-        
-        if subtotal < promotion.min_order_amount:
+            elif subtotal < promotion.min_order_amount:
+                return jsonify({
+                    'valid': False,
+                    'message': f'Minimum order amount is ₹{promotion.min_order_amount:.0f}'
+                })
+            
             return jsonify({
                 'valid': False,
-                'message': f'Minimum order amount is ₹{promotion.min_order_amount:.0f}'
+                'message': 'Invalid or expired coupon code'
             })
         
-        discount = promotion.calculate_discount(subtotal)
+        discount = promotion.discount_amount(subtotal)
         
         # Format discount message
         if promotion.discount_type == 'percentage':
@@ -1235,7 +1181,7 @@ def api_validate_coupon():
         })
             
     except Exception as e:
-        app.logger.error(f"Coupon validation error: {e}")
+        current_app.logger.error(f"Coupon validation error: {e}")
         return jsonify({
             'valid': False,
             'message': 'Error validating coupon. Please try again.'
@@ -1243,11 +1189,11 @@ def api_validate_coupon():
 
 # Error handlers
 
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def not_found(error):
     return render_template('404.html'), 404
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
     return render_template('500.html'), 500
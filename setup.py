@@ -12,13 +12,15 @@ setup(
     install_requires=[
         "email-validator>=2.3.0",
         "flask>=3.1.2",
+        "flask-session>=0.8.0",
         "flask-sqlalchemy>=3.1.1",
         "gunicorn>=23.0.0",
         "pillow>=11.3.0",
         "psycopg2-binary>=2.9.10",
-        "pytz>=2025.2",
         "qrcode>=8.2",
+        "redis>=5.0.0",
         "sqlalchemy>=2.0.43",
+        "tzdata>=2024.1",
         "werkzeug>=3.1.3",
         "requests>=2.31.0",
     ],
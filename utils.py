@@ -1,32 +1,62 @@
 import qrcode
 from io import BytesIO
 import base64
-from datetime import datetime, timedelta
+from bisect import bisect_right
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
 import re
-import pytz
-from flask import session
-from models import User, StoreSettings, CartItem, MenuItem, Promotion
-from app import db
+from flask import g, session
+from sqlalchemy.dialects import postgresql, sqlite
+from models import (db, User, StoreSettings, CartItem, MenuItem, Promotion, IST, get_ist_now,
+                    cached, invalidate_cached)
+
+# Menu and promotion lists are kept in the shared TTL cache (models.cached).
+# Admin edits clear them through invalidate_menu_cache() and
+# invalidate_promotion_cache().
+MENU_CACHE_TTL = 300
+CATEGORY_CACHE_TTL = 60
+PROMOTION_CACHE_TTL = 60
+
+def invalidate_menu_cache():
+    """Drop cached categories and popular items after a menu change"""
+    invalidate_cached(('menu',))
+
+def invalidate_promotion_cache():
+    """Drop the cached checkout promotions after a promotion change"""
+    invalidate_cached(('promotions',))
 
 def generate_qr_code(data, amount=None):
     """Generate QR code for UPI payment"""
     if amount:
-        # UPI payment string format
-        upi_string = f"upi://pay?pa=7903102794@ptsbi&pn=Biryani Club&am={amount}&cu=INR&tn=Order Payment"
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(upi_string)
-        qr.make(fit=True)
-
-        img = qr.make_image(fill_color="black", back_color="white")
-        buffer = BytesIO()
-        img.save(buffer, format='PNG')
-        buffer.seek(0)
-
-        # Convert to base64 for HTML embedding
-        img_str = base64.b64encode(buffer.getvalue()).decode()
-        return f"data:image/png;base64,{img_str}"
+        return _upi_qr_code(amount)
     return None
 
+# Constant part of the UPI payment URI (already URL-encoded); only the amount
+# is appended per order
+_UPI_PREFIX = "upi://pay?pa=7903102794@ptsbi&pn=Biryani%20Club&cu=INR&tn=Order%20Payment&am="
+
+@lru_cache(maxsize=512)
+def _upi_qr_code(amount):
+    """Render the UPI payment QR as a PNG data URI
+
+    The payload depends only on the amount, so orders with the same total
+    share one cached image.
+    """
+    # UPI payment string format
+    upi_string = _UPI_PREFIX + str(amount)
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(upi_string)
+    qr.make(fit=True)
+
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffer = BytesIO()
+    img.save(buffer, format='PNG')
+    buffer.seek(0)
+
+    # Convert to base64 for HTML embedding
+    img_str = base64.b64encode(buffer.getvalue()).decode()
+    return f"data:image/png;base64,{img_str}"
+
 def is_store_open():
     """Check if store is currently open"""
     try:
@@ -36,129 +66,205 @@ def is_store_open():
         return True
 
 def get_current_user():
-    """Get current logged in user"""
-    if 'user_id' in session:
-        return User.query.get(session['user_id'])
-    return None
+    """Get current logged in user, loaded at most once per request into g.user"""
+    if 'user_id' not in session:
+        return None
+    if 'user' not in g:
+        g.user = db.session.get(User, session['user_id'])
+    return g.user
 
 def get_cart_items(user_id=None):
-    """Get cart items for a user"""
+    """Get cart items for a user as (items, subtotal)"""
     if not user_id and 'user_id' in session:
         user_id = session['user_id']
 
+    items = []
+    subtotal = 0
     if user_id:
-        cart_items = CartItem.query.filter_by(user_id=user_id).join(MenuItem).all()
-        return [
-            {
-                'id': item.menu_item.id,
-                'name': item.menu_item.name,
-                'price': item.menu_item.price,
-                'quantity': item.quantity,
-                'total': item.total,
-                'emoji': item.menu_item.emoji
-            }
-            for item in cart_items
-        ]
-    return []
+        # Select just the columns the cart needs, in one joined query and
+        # without building CartItem/MenuItem objects
+        rows = (db.session.query(MenuItem.id, MenuItem.name, MenuItem.price,
+                                 CartItem.quantity, MenuItem.emoji)
+                .join(CartItem, CartItem.menu_item_id == MenuItem.id)
+                .filter(CartItem.user_id == user_id)
+                .order_by(CartItem.id)
+                .all())
+        for item_id, name, price, quantity, emoji in rows:
+            total = price * quantity
+            subtotal += total
+            items.append({
+                'id': item_id,
+                'name': name,
+                'price': price,
+                'quantity': quantity,
+                'total': total,
+                'emoji': emoji
+            })
+    return items, subtotal
+
+def _cart_aggregate(name, user_id, loader):
+    """Memoize a cart aggregate on g for the rest of the request"""
+    cache = g.setdefault('cart_aggregates', {})
+    key = (name, user_id)
+    if key not in cache:
+        cache[key] = loader()
+    return cache[key]
 
 def get_cart_total(user_id=None):
     """Calculate cart total for a user"""
-    cart_items = get_cart_items(user_id)
-    return sum(item['total'] for item in cart_items)
+    user_id = user_id or session.get('user_id')
+    if not user_id:
+        return 0
+    return _cart_aggregate('total', user_id, lambda: db.session.query(
+        db.func.coalesce(db.func.sum(CartItem.quantity * MenuItem.price), 0)
+    ).join(CartItem.menu_item).filter(CartItem.user_id == user_id).scalar())
 
 def get_cart_count(user_id=None):
     """Get cart items count"""
-    cart_items = get_cart_items(user_id)
-    return sum(item['quantity'] for item in cart_items)
-
-def clear_user_cart(user_id):
-    """Clear all items from user's cart"""
-    CartItem.query.filter_by(user_id=user_id).delete()
-    db.session.commit()
+    user_id = user_id or session.get('user_id')
+    if not user_id:
+        return 0
+    return _cart_aggregate('count', user_id, lambda: db.session.query(
+        db.func.coalesce(db.func.sum(CartItem.quantity), 0)
+    ).filter(CartItem.user_id == user_id).scalar())
+
+def refresh_cart_count():
+    """Recompute the cart count kept in the session; call after the cart changes"""
+    g.pop('cart_aggregates', None)
+    session['cart_count'] = get_cart_count() if 'user_id' in session else 0
+    return session['cart_count']
+
+def session_cart_count():
+    """Cart count for templates, read from the session instead of the database"""
+    if 'user_id' not in session:
+        return 0
+    if 'cart_count' not in session:
+        # Sessions created before the count was tracked
+        return refresh_cart_count()
+    return session['cart_count']
+
+# Most of any one cart item a user can hold
+MAX_CART_QUANTITY = 10
+
+def upsert_cart_item(user_id, menu_item_id, quantity):
+    """Add quantity to a user's cart line in one INSERT ... ON CONFLICT statement
+
+    An existing (user_id, menu_item_id) row has the quantity added to it,
+    capped at MAX_CART_QUANTITY.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        stmt = postgresql.insert(CartItem)
+        capped = db.func.least
+    else:
+        stmt = sqlite.insert(CartItem)
+        capped = db.func.min  # two-argument min() is SQLite's scalar minimum
+    stmt = stmt.values(user_id=user_id, menu_item_id=menu_item_id, quantity=quantity)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'menu_item_id'],
+        set_={'quantity': capped(CartItem.quantity + stmt.excluded.quantity, MAX_CART_QUANTITY)}
+    )
+    db.session.execute(stmt)
+
+def clear_user_cart(user_id, commit=True):
+    """Clear all items from user's cart
+
+    Pass ``commit=False`` to leave the delete in the caller's transaction.
+    """
+    CartItem.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+    if commit:
+        db.session.commit()
+
+# Validation patterns, compiled once at import
+_NONDIGIT_RE = re.compile(r'\D')
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
+def clean_phone(phone):
+    """Strip everything but digits from a phone number"""
+    return _NONDIGIT_RE.sub('', phone)
 
 def validate_phone(phone):
     """Validate phone number format"""
     if not phone:
         return False
-    # Remove all non-digits
-    cleaned = re.sub(r'\D', '', phone)
-    # Check if it's between 10-15 digits
-    return 10 <= len(cleaned) <= 15
+    # Check if it's between 10-15 digits once non-digits are removed
+    return 10 <= len(clean_phone(phone)) <= 15
 
 def validate_email(email):
     """Validate email format"""
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return _EMAIL_RE.match(email) is not None
 
 def find_user_by_login(identifier):
     """Find user by username or phone number"""
-    # First try to find by username
-    user = User.query.filter_by(username=identifier).first()
-    if user:
-        return user
-
-    # Clean the identifier and check if it looks like a phone number
-    cleaned_identifier = re.sub(r'\D', '', identifier)
-
-    # If it's likely a phone number, search by phone
-    if len(cleaned_identifier) >= 10 and len(cleaned_identifier) <= 15:
-        # Try exact match first
-        user = User.query.filter_by(phone=cleaned_identifier).first()
-        if user:
-            return user
-
-        # Try with original input (in case it has formatting)
-        user = User.query.filter_by(phone=identifier).first()
-        if user:
-            return user
-
-    return None
+    # Username match (case-insensitive)
+    username_match = db.func.lower(User.username) == identifier.lower()
+    conditions = [username_match]
+
+    # If it's likely a phone number, also match the phone, either cleaned or
+    # as typed (in case it was stored with formatting)
+    cleaned_identifier = clean_phone(identifier)
+    if 10 <= len(cleaned_identifier) <= 15:
+        conditions += [User.phone == cleaned_identifier, User.phone == identifier]
+
+    # One query; an exact username match wins over a case-insensitive one
+    # (older databases may hold usernames differing only by case), and any
+    # username match wins over a phone match
+    return User.query.filter(db.or_(*conditions)).order_by(
+        db.case((User.username == identifier, 0), (username_match, 1), else_=2)
+    ).first()
 
 def apply_coupon(coupon_code, subtotal):
     """Apply coupon and return discount amount"""
     if not coupon_code:
         return 0
 
-    from models import Promotion
-
-    # Find promotion in database
-    promotion = Promotion.query.filter_by(code=coupon_code.upper().strip()).first()
+    # Find the promotion only if it is valid for this subtotal
+    promotion = Promotion.query.filter(
+        *Promotion.redeemable(coupon_code.upper().strip(), subtotal)
+    ).first()
 
     if not promotion:
         return 0
 
-    if not promotion.is_valid:
-        return 0
-
-    # Check minimum order amount
-    if subtotal < promotion.min_order_amount:
-        return 0
+    return promotion.discount_amount(subtotal)
 
-    return promotion.calculate_discount(subtotal)
+# Delivery charge by order amount: 25rs below 150rs, 15rs from 150rs, and
+# free delivery from 200rs
+_DELIVERY_THRESHOLDS = (150, 200)
+_DELIVERY_CHARGES = (25, 15, 0)
 
 def calculate_delivery_charges(subtotal):
     """Calculate delivery charges based on order amount"""
-    if subtotal >= 200:
-        return 0  # Free delivery for orders 200rs and above
-    elif subtotal >= 150:
-        return 15  # 15rs delivery for orders 150rs and above
-    elif subtotal >= 100:
-        return 25  # 25rs delivery for orders 100rs and above
-    else:
-        return 25  # Default delivery charge for orders below 100rs
+    return _DELIVERY_CHARGES[bisect_right(_DELIVERY_THRESHOLDS, subtotal)]
 
 def get_popular_items(limit=6):
     """Get popular menu items"""
     try:
-        return MenuItem.query.filter_by(in_stock=True).order_by(MenuItem.popularity.desc()).limit(limit).all()
+        # Cache plain rows rather than ORM instances, which expire (and then
+        # detach) when the session that loaded them commits or rolls back
+        return cached(('menu', 'popular_items', limit), lambda: db.session.query(
+            MenuItem.id, MenuItem.name, MenuItem.description, MenuItem.price,
+            MenuItem.category, MenuItem.emoji, MenuItem.popularity
+        ).filter(MenuItem.in_stock == True).order_by(MenuItem.popularity.desc()).limit(limit).all(),
+            ttl=MENU_CACHE_TTL)
     except:
         return []
 
+def get_available_promotions(limit=8):
+    """Get the newest active, unexpired promotions shown at checkout"""
+    return cached(('promotions', 'available', limit), lambda: db.session.query(
+        Promotion.code, Promotion.description, Promotion.discount_type,
+        Promotion.discount_value, Promotion.max_discount, Promotion.min_order_amount
+    ).filter(
+        Promotion.is_active == True,
+        Promotion.expires_at.is_(None) | (Promotion.expires_at > get_ist_now())
+    ).order_by(Promotion.created_at.desc()).limit(limit).all(), ttl=PROMOTION_CACHE_TTL)
+
 def get_categories():
     """Get all menu categories"""
     try:
-        categories = db.session.query(MenuItem.category).distinct().all()
-        return [cat[0] for cat in categories]
+        return cached(('menu', 'categories'), lambda: [
+            cat[0] for cat in db.session.query(MenuItem.category).distinct().all()
+        ], ttl=CATEGORY_CACHE_TTL)
     except:
         return []
 
@@ -167,7 +273,7 @@ def format_phone_display(phone):
     if not phone:
         return ""
 
-    cleaned = re.sub(r'\D', '', phone)
+    cleaned = clean_phone(phone)
     if len(cleaned) == 10:
         return f"({cleaned[:3]}) {cleaned[3:6]}-{cleaned[6:]}"
     return phone
@@ -191,16 +297,14 @@ def generate_random_order_id():
 
 def get_ist_time():
     """Get current time in IST timezone"""
-    ist = pytz.timezone('Asia/Kolkata')
-    return datetime.now(ist)
+    return datetime.now(IST)
 
 def utc_to_ist(utc_datetime):
     """Convert UTC datetime to IST"""
     if not utc_datetime:
         return None
-    ist = pytz.timezone('Asia/Kolkata')
-    utc_time = utc_datetime.replace(tzinfo=pytz.utc)
-    return utc_time.astimezone(ist)
+    utc_time = utc_datetime.replace(tzinfo=timezone.utc)
+    return utc_time.astimezone(IST)
 
 def format_ist_datetime(dt, format_str='%d %b %Y, %I:%M %p IST'):
     """Format datetime in IST with default format"""
@@ -209,7 +313,7 @@ def format_ist_datetime(dt, format_str='%d %b %Y, %I:%M %p IST'):
     if dt.tzinfo is None:
         # Assume UTC if no timezone info
         dt = utc_to_ist(dt)
-    elif dt.tzinfo != pytz.timezone('Asia/Kolkata'):
+    elif dt.tzinfo != IST:
         # Convert to IST if different timezone
-        dt = dt.astimezone(pytz.timezone('Asia/Kolkata'))
+        dt = dt.astimezone(IST)
     return dt.strftime(format_str) if dt else ''
\ No newline at end of file